@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+# cython: language_level=3
 
 """
 Here's the consistency server module. It's a server app making it possible for clients (WebApps
@@ -21,16 +22,161 @@ critical).
 """
 
 import sys
+import zlib
 import json
-import time
+import struct
+import logging
 import signal
 import asyncio
 import argparse
-
+import socket
+import multiprocessing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from autobahn.exception import Disconnected
+from autobahn.websocket.compress import (PerMessageDeflate, PerMessageDeflateOffer,
+                                         PerMessageDeflateOfferAccept)
 from autobahn.asyncio.websocket import WebSocketServerProtocol, WebSocketServerFactory
 
 CONSISTENCY_SERVER = None
 
+# Maximum number of notices waiting to be sent to a client before we consider he can't keep up and
+# drop his connection.
+MAX_QUEUED_MESSAGES = 1024
+
+# Maximum size in bytes of a message sent by the backend. A bigger length prefix most likely means
+# the backend doesn't frame its messages (see FramedProtocol), so its connection is closed.
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+LOGGER = logging.getLogger(__name__)
+
+class JSONCodec:
+    """
+    The default application level protocol : messages are JSON objects sent as text frames to the
+    clients and as UTF-8 encoded bytes to the backend. orjson is used when it is installed, the
+    standard json module otherwise. Note that orjson decodes integers that don't fit in 64 bits
+    as floats (see the README).
+    """
+
+    name = "json"
+    binary = False
+
+    def encode(self, data):
+        """ Turns a message (a dict) into the bytes sent over the wire """
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data).encode('utf8')
+
+    def decode(self, msg):
+        """ Turns the bytes received from the wire back into a message """
+        if orjson is not None:
+            return orjson.loads(msg)
+        # json.loads would guess the encoding of bytes and let invalid UTF-8 through
+        return json.loads(msg.decode('utf8'))
+
+    def invalidate_template(self, uri):
+        """
+        Returns the bytes surrounding the content in an invalidate notice for uri, so that the
+        notice is prefix + encode(content) + suffix without building and encoding the whole message
+        """
+        prefix = b'{"message":"invalidate","data":{"uri":' + self.encode(uri) + b',"content":'
+        return prefix, b'}}'
+
+
+class MsgPackCodec:
+    """
+    A binary alternative to JSONCodec relying on MessagePack. Messages have exactly the same shape
+    but they are smaller and cheaper to encode and decode. Since it's binary, the frames sent to
+    the clients are binary WebSocket frames. Requires the msgpack package.
+    """
+
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack package is required to use MsgPackCodec")
+
+    def encode(self, data):
+        """ Turns a message (a dict) into the bytes sent over the wire """
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, msg):
+        """ Turns the bytes received from the wire back into a message """
+        return msgpack.unpackb(msg, raw=False)
+
+    def invalidate_template(self, uri):
+        """
+        Returns the bytes surrounding the content in an invalidate notice for uri, so that the
+        notice is prefix + encode(content) + suffix without building and encoding the whole message
+        """
+        prefix = (b'\x82' + self.encode("message") + self.encode("invalidate") + self.encode("data")
+                  + b'\x82' + self.encode("uri") + self.encode(uri) + self.encode("content"))
+        return prefix, b''
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, MsgPackCodec)}
+
+
+def build_frame(payload, binary=False, compressed=False):
+    """
+    Builds a complete, unmasked and unfragmented server to client WebSocket frame (RFC 6455)
+    holding payload. It makes it possible to frame a notice once and write the very same bytes to
+    all the clients watching a resource. If compressed is True, payload must come from
+    deflate_payload and the frame is flagged as such (RSV1 bit, RFC 7692).
+    """
+    first_byte = 0x80 | (0x2 if binary else 0x1)
+    if compressed:
+        first_byte |= 0x40
+    length = len(payload)
+
+    if length < 126:
+        header = struct.pack('!BB', first_byte, length)
+    elif length < (1 << 16):
+        header = struct.pack('!BBH', first_byte, 126, length)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, length)
+
+    return header + payload
+
+
+def deflate_payload(payload):
+    """
+    Compresses payload on its own (no context shared with any previous message) the way
+    permessage-deflate expects it, so that the result can be sent to any client having negotiated
+    permessage-deflate with accept_deflate_offer.
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def accept_deflate_offer(offers):
+    """
+    Accepts the permessage-deflate offers compatible with notices compressed once for all the
+    clients : the client must not restrict the server window size, and the server doesn't keep its
+    compression context between messages since the shared notices are interleaved with the ones
+    compressed by autobahn.
+    """
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer) and not offer.request_max_window_bits:
+            return PerMessageDeflateOfferAccept(offer, no_context_takeover=True)
+    return None
+
 class Resource:
     """
     A very simple entity representing a resource that will be watched by clients and regularly
@@ -39,31 +185,92 @@ class Resource:
 
     def __init__(self, uri, consistency_server):
         self._uri = uri
-        self._clients = list()
-        self._last_update_date = time.time()
+        self._clients = set()
         self._consistency_server = consistency_server
+        self._last_update_date = consistency_server.event_loop.time()
+        codec = consistency_server.codec
+        self._invalidate_payload = codec.encode({"message": "invalidate", "data":{"uri": uri}})
+        self._invalidate_frame = build_frame(self._invalidate_payload, codec.binary)
+        self._invalidate_deflate_frame = None
+        self._content_prefix, self._content_suffix = codec.invalidate_template(uri)
+
+    def _encode_invalidate(self, content):
+        """
+        Builds the invalidate notice carrying content sent to the clients watching the current
+        resource. Only the content is encoded, the rest of the message is the same for every update
+        and has been encoded once and for all in the constructor. Returns the payload and the
+        WebSocket frame holding it, which is the same for all the clients so it is built once and
+        the bytes are shared.
+        """
+        codec = self._consistency_server.codec
+        payload = self._content_prefix + codec.encode(content) + self._content_suffix
+        return payload, build_frame(payload, codec.binary)
+
+    def _build_deflate_frame(self, payload, frame):
+        """
+        Returns the frame for the clients having negotiated permessage-deflate : payload compressed
+        (once for all of them) if it is at least compress_threshold bytes long, frame otherwise.
+        """
+        threshold = self._consistency_server.compress_threshold
+
+        if threshold is None or len(payload) < threshold:
+            return frame
+
+        return build_frame(deflate_payload(payload), self._consistency_server.codec.binary,
+                           compressed=True)
 
-    def update(self, content=None):
+    def update(self, content=None, update_date=None):
         """
         Called when the resource identified by the current instance is modified in the backend.
         It notifies all the clients watching it that it changed (and therefore, make them refresh).
+        A client whose connection is already gone doesn't prevent the others from being notified,
+        it's simply removed from the listeners, and so is a client too slow to read them.
+        update_date is the event loop time of the update (the current one by default).
         """
-        self._last_update_date = time.time()
+        if update_date is None:
+            update_date = self._consistency_server.event_loop.time()
+        self._last_update_date = update_date
+
+        if content is None:
+            payload, frame = self._invalidate_payload, self._invalidate_frame
+            deflate_frame = self._invalidate_deflate_frame
+        else:
+            payload, frame = self._encode_invalidate(content)
+            deflate_frame = None
+
+        dead_clients = list()
         for client in self._clients:
-            client.protocol.invalidate(self, content)
+            if client.protocol.deflate:
+                # Only compressed when a client needs it, and then once for all of them
+                if deflate_frame is None:
+                    deflate_frame = self._build_deflate_frame(payload, frame)
+                    if content is None:
+                        self._invalidate_deflate_frame = deflate_frame
+                client_frame = deflate_frame
+            else:
+                client_frame = frame
+
+            try:
+                client.send(client_frame)
+            except asyncio.QueueFull:
+                dead_clients.append(client)
+
+        for client in dead_clients:
+            client.protocol.dropConnection(abort=True)
+            client.stop_watching()
 
     def add_client(self, client):
         """
         Add a client to the list of those watching the current resource instance
         """
-        self._clients.append(client)
+        self._clients.add(client)
 
     def remove_client(self, client):
         """
         Removes a listener. In case there's no listener on the current resource, we ask consistency
         server to remove the current resource from its list of resources.
         """
-        self._clients.remove(client)
+        self._clients.discard(client)
 
         if len(self._clients) == 0:
             self._consistency_server.remove_resource(self)
@@ -86,10 +293,44 @@ class Client:
 
     def __init__(self, protocol):
         self._protocol = protocol
-        self._resources = list()
+        self._resources = set()
+        self._out_queue = asyncio.Queue(maxsize=MAX_QUEUED_MESSAGES)
+        self._writer = None
+
+    def start_writing(self):
+        """
+        Starts the task sending the queued notices to the client. Each client has its own so that a
+        slow one only holds back his own notices.
+        """
+        self._writer = asyncio.ensure_future(self._run_writer())
+
+    def stop_writing(self):
+        """
+        Stops the task sending the queued notices to the client, the ones left are discarded
+        """
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    def send(self, frame):
+        """
+        Queues a notice (already framed, see build_frame) for the client. Raises asyncio.QueueFull
+        if there are already MAX_QUEUED_MESSAGES notices waiting for him.
+        """
+        self._out_queue.put_nowait(frame)
 
-    def __del__(self):
-        self.stop_watching()
+    async def _run_writer(self):
+        """
+        Sends the queued notices to the client, waiting for the connection to accept more data
+        whenever the transport buffer is full.
+        """
+        while True:
+            frame = await self._out_queue.get()
+            await self._protocol.wait_writable()
+            try:
+                self._protocol.invalidate(frame)
+            except (Disconnected, ConnectionError):
+                return
 
     def stop_watching(self):
         """
@@ -98,6 +339,25 @@ class Client:
         for resource in self._resources:
             resource.remove_client(self)
 
+        self._resources.clear()
+
+    def watch(self, resource):
+        """
+        Registers the client as a listener of resource. The client keeps track of the resources he
+        watches so that he can be unregistered from all of them at once when he leaves.
+        """
+        if resource not in self._resources:
+            self._resources.add(resource)
+            resource.add_client(self)
+
+    def unwatch(self, resource):
+        """
+        Unregisters the client from the listeners of resource
+        """
+        if resource in self._resources:
+            self._resources.discard(resource)
+            resource.remove_client(self)
+
     def _get_protocol(self):
         """
         Returns a reference to the Protocol instance holding the connexion with the client (yes
@@ -107,26 +367,124 @@ class Client:
     protocol = property(_get_protocol, doc="Handle on the Websocket connection with the client")
 
 
-class BackendProtocol(asyncio.Protocol):
+class FramedProtocol(asyncio.Protocol):
+    """
+    A stream protocol where each message is preceded by its length in bytes, as a 4 bytes
+    big-endian unsigned integer, so that a single connection can carry as many messages as needed.
+    Subclasses handle the messages in message_received.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        """
+        Accumulates the bytes sent by the backend and handles every complete message they hold. A
+        message may be split over several calls, and a call may hold several messages. The
+        connection is closed if a message is announced bigger than MAX_MESSAGE_SIZE.
+        """
+        self._buffer.extend(data)
+
+        offset = 0
+        while len(self._buffer) - offset >= 4:
+            length, = struct.unpack_from('!I', self._buffer, offset)
+            if length > MAX_MESSAGE_SIZE:
+                LOGGER.error("Closing the backend connection: announced message length %d exceeds "
+                             "MAX_MESSAGE_SIZE (is the backend prefixing its messages with their "
+                             "length?)", length)
+                self._buffer.clear()
+                self._transport.close()
+                return
+            if len(self._buffer) - offset - 4 < length:
+                break
+            msg = bytes(self._buffer[offset + 4:offset + 4 + length])
+            offset += 4 + length
+            try:
+                self.message_received(msg)
+            except Exception:
+                # A bad message must not take the whole (persistent) connection down with it
+                LOGGER.exception("Skipping a backend message that couldn't be handled: %r",
+                                 msg[:200])
+
+        if offset:
+            del self._buffer[:offset]
+
+    def message_received(self, msg):
+        """
+        Called with every complete message received (without its length prefix)
+        """
+        raise NotImplementedError()
+
+
+class BackendProtocol(FramedProtocol):
     """
-    A protocol for communication between the backend side of the application and consistency
+    A protocol for communication between the backend side of the application and consistency.
+    Each backend process is expected to keep a single connection open and stream all its updates
+    over it (see the README).
     """
 
     def __init__(self, consistency_server):
+        super().__init__()
         self._consistency_server = consistency_server
 
-    def data_received(self, msg):
+    def message_received(self, msg):
         """
         Handles messages sent by the backend to consistency when a resource has been modified.
         These messages respect the following pattern :
-        {"message": "update", "data":{"uri": "my_uri", "data": "my_Data"}}
+        {"message": "update", "data":{"uri": "my_uri", "content": "my_Data"}}
         """
-        data = json.loads(msg.decode('utf8'))
+        data = self._consistency_server.codec.decode(msg)
         if data["message"] == "update":
             uri = data["data"]["uri"]
             content = data["data"]["content"] if "content" in data["data"] else None
             self._consistency_server.update(uri, content)
 
+    def connection_lost(self, exc):
+        """
+        Called when the backend (or the main process, for a worker) closes the connection
+        """
+        self._consistency_server.backend_connection_lost()
+
+
+class BackendRelayProtocol(FramedProtocol):
+    """
+    Used when consistency runs several worker processes (see the --workers option) : the backend
+    connects to the main process which forwards every message to all the workers, since any of them
+    may hold clients watching the updated resource.
+    """
+
+    def __init__(self, workers):
+        super().__init__()
+        self._workers = workers
+
+    def message_received(self, msg):
+        """
+        Forwards a message from the backend to the workers, framed the same way
+        """
+        frame = struct.pack('!I', len(msg)) + msg
+        for worker in self._workers:
+            worker.write(frame)
+
+
+class WorkerLinkProtocol(asyncio.Protocol):
+    """
+    The main process end of the connection with a worker (see the --workers option). Nothing is
+    ever read from it, it's only there to notice when the worker goes away.
+    """
+
+    def __init__(self, worker_lost):
+        self._worker_lost = worker_lost
+
+    def connection_lost(self, exc):
+        """
+        Called when the worker exits, or when the main process closes the connection
+        """
+        self._worker_lost()
+
 
 class ClientProtocol(WebSocketServerProtocol):
     """
@@ -134,28 +492,62 @@ class ClientProtocol(WebSocketServerProtocol):
     has been made
     """
     def __init__(self):
+        super().__init__()
         self._client_representation = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._deflate = False
+
+    def pause_writing(self):
+        """
+        Called by the transport when its write buffer goes over the high-water mark
+        """
+        super().pause_writing()
+        self._writable.clear()
 
-    def invalidate(self, resource, content=None):
+    def resume_writing(self):
         """
-        Notifies the client the the resource identified by resource.uri on the client side is not
-        consistent with the server anymore and has therefore to be refreshed.
+        Called by the transport when its write buffer is drained below the low-water mark
         """
-        data = {"message": "invalidate", "data":{"uri": resource.uri}}
+        super().resume_writing()
+        self._writable.set()
 
-        if content is not None:
-            data["data"]["content"] = content
+    async def wait_writable(self):
+        """
+        Waits until the connection is ready to accept more data
+        """
+        await self._writable.wait()
 
-        msg = json.dumps(data).encode('utf8')
+    def invalidate(self, frame):
+        """
+        Notifies the client that a resource he's watching is not consistent with the server anymore
+        and has therefore to be refreshed. frame is the invalidate notice already encoded and
+        framed by the resource (see Resource.update), it is shared between all the clients watching
+        it and therefore written as is to the transport instead of going through sendMessage.
+        """
+        if self.state != self.STATE_OPEN:
+            raise Disconnected("Attempt to send on a closed protocol")
 
-        self.sendMessage(msg)
+        self.transport.write(frame)
 
     def onConnect(self, request):
         """
-        Called everytime a WebSocket client is bound to Consistency
+        Called everytime a WebSocket client is bound to Consistency. If the client offered the name
+        of the codec in use as a subprotocol, we agree on it during the handshake.
         """
         self._client_representation = Client(self)
 
+        if CONSISTENCY_SERVER.codec.name in request.protocols:
+            return CONSISTENCY_SERVER.codec.name
+
+    def onOpen(self):
+        """
+        Called when the WebSocket handshake is over, from then on the client can be notified
+        """
+        self._deflate = any(isinstance(extension, PerMessageDeflate)
+                            for extension in self.websocket_extensions_in_use)
+        self._client_representation.start_writing()
+
     def onMessage(self, msg, is_binary):
         """
         The messages of the client are there only to register him as a listener for some resource,
@@ -165,20 +557,19 @@ class ClientProtocol(WebSocketServerProtocol):
         The message sent by the client should respect the following standard :
         {"message": "watch", "data":{"uri": "my_uri"}}
         """
-        if not is_binary:
-            data = json.loads(msg.decode('utf8'))
+        codec = CONSISTENCY_SERVER.codec
+        if is_binary == codec.binary:
+            data = codec.decode(msg)
             if data["message"] == "watch":
                 uri = data["data"]["uri"]
                 CONSISTENCY_SERVER.watch(self._client_representation, uri)
                 response_data = {"message": "watched", "data":{"uri": uri}}
-                response = json.dumps(response_data).encode('utf8')
-                self.sendMessage(response)
+                self.sendMessage(codec.encode(response_data), isBinary=codec.binary)
             elif data["message"] == "unwatch":
                 uri = data["data"]["uri"]
                 CONSISTENCY_SERVER.unwatch(self._client_representation, uri)
                 response_data = {"message": "unwatched", "data":{"uri": uri}}
-                response = json.dumps(response_data).encode('utf8')
-                self.sendMessage(response)
+                self.sendMessage(codec.encode(response_data), isBinary=codec.binary)
 
 
     def onClose(self, wasClean, code, reason):
@@ -187,7 +578,16 @@ class ClientProtocol(WebSocketServerProtocol):
         current client from all the resources it was watching.
         """
         if self._client_representation:
-            del self._client_representation
+            self._client_representation.stop_writing()
+            self._client_representation.stop_watching()
+            self._client_representation = None
+
+    def _get_deflate(self):
+        """
+        Whether permessage-deflate has been negotiated with the client
+        """
+        return self._deflate
+    deflate = property(_get_deflate, doc="True if the client accepts compressed notices")
 
 
 class ConsistencyServer:
@@ -200,61 +600,312 @@ class ConsistencyServer:
     port_backend : same for the backend
     PublicProt : (defaut ClientProtocol) protocol to talk with the clients
     BackendProt : (default BackendProtocol) protocol to talk with the backend
+    Codec : (default JSONCodec) application level protocol used both with the clients and the
+            backend
+    update_delay : (default 0.005) time in seconds during which the updates of a resource are
+                   coalesced before its clients get notified
+    compress_threshold : (default None) minimal size in bytes of the notices compressed for the
+                         clients supporting permessage-deflate, None disables compression
+    backend_unix_path : (default None) path of a Unix domain socket to listen on for the backend
+                        instead of addr_backend and port_backend (when both run on the same host)
+    reuse_port : (default False) lets several processes listen on port_public at the same time
+    backend_sock : (default None) an already connected socket to read the backend messages from
+                   instead of listening on addr_backend and port_backend (used by the workers)
     """
 
     def __init__(self, addr_public, addr_backend, port_public, port_backend,
-                 PublicProt=ClientProtocol, BackendProt=BackendProtocol):
+                 PublicProt=ClientProtocol, BackendProt=BackendProtocol, Codec=JSONCodec,
+                 update_delay=0.005, compress_threshold=None, backend_unix_path=None,
+                 reuse_port=False, backend_sock=None):
         self._resources = dict()
-
-        public_factory = WebSocketServerFactory("ws://" + addr_public + ":" + str(port_public))
-
-        public_factory.protocol = PublicProt
-
-        self._event_loop = asyncio.get_event_loop()
-
-        asyncio.Task(self._event_loop.create_server(public_factory, addr_public, port_public))
-        asyncio.Task(self._event_loop.create_server(lambda: BackendProt(self), addr_backend,
-                                                    port_backend))
+        self._codec = Codec()
+        self._update_delay = update_delay
+        self._pending_updates = dict()
+        self._flush_handle = None
+        self._compress_threshold = compress_threshold
+        self._addr_public = addr_public
+        self._addr_backend = addr_backend
+        self._port_public = port_public
+        self._port_backend = port_backend
+        self._public_prot = PublicProt
+        self._backend_prot = BackendProt
+        self._reuse_port = reuse_port
+        self._backend_unix_path = backend_unix_path
+        self._backend_sock = backend_sock
+        self._event_loop = None
+        self._closing = None
+        self._servers = list()
+
+
+    async def start(self):
+        """
+        Starts listening for the clients and the backend in the running event loop. Errors (an
+        address already in use for instance) are raised from here.
+        """
+        self._event_loop = asyncio.get_running_loop()
+        self._closing = asyncio.Event()
+
+        # The factory binds itself to the current event loop, it must be created in the running one
+        public_factory = WebSocketServerFactory("ws://" + self._addr_public + ":"
+                                                + str(self._port_public),
+                                                protocols=[self._codec.name])
+
+        public_factory.protocol = self._public_prot
+
+        # Invalidate notices are framed (and compressed) once for all the clients (see
+        # build_frame), which doesn't play well with per-connection compression contexts, hence
+        # the restrictions of accept_deflate_offer.
+        # When the incoming text frames are parsed by orjson, which rejects invalid UTF-8 already,
+        # autobahn doesn't have to validate them beforehand. The standard json module and binary
+        # codecs (which ignore text frames) leave that check to autobahn.
+        if self._compress_threshold is None:
+            accept_offer = lambda offers: None
+        else:
+            accept_offer = accept_deflate_offer
+        utf8_validated_by_codec = isinstance(self._codec, JSONCodec) and orjson is not None
+        public_factory.setProtocolOptions(perMessageCompressionAccept=accept_offer,
+                                          utf8validateIncoming=not utf8_validated_by_codec)
+
+        self._servers.append(await self._event_loop.create_server(
+            public_factory, self._addr_public, self._port_public,
+            reuse_port=self._reuse_port))
+
+        if self._backend_sock is not None:
+            transport, _ = await self._event_loop.connect_accepted_socket(
+                lambda: self._backend_prot(self), self._backend_sock)
+            self._servers.append(transport)
+        elif self._backend_unix_path is not None:
+            self._servers.append(await self._event_loop.create_unix_server(
+                lambda: self._backend_prot(self), self._backend_unix_path))
+        else:
+            self._servers.append(await self._event_loop.create_server(
+                lambda: self._backend_prot(self), self._addr_backend, self._port_backend))
+
+    async def serve(self):
+        """ Starts the server (unless start() has already been called) and runs it until close()
+        is called """
+        if self._closing is None:
+            await self.start()
+        try:
+            await self._closing.wait()
+        finally:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+
+            for server in self._servers:
+                server.close()
+            self._servers.clear()
 
     def run_forvever(self):
-        """ Runs the server until close() is called """
-        self._event_loop.run_forever()
+        """ Runs the server in a new event loop until close() is called """
+        asyncio.run(self.serve())
 
     def close(self):
         """ Terminates the server """
-        self._event_loop.close()
+        if self._closing is not None:
+            self._closing.set()
+
+    def backend_connection_lost(self):
+        """ Called when a backend connection is closed. A worker reading the backend messages from
+        backend_sock has nothing left to do once the main process closed it, so it terminates. """
+        if self._backend_sock is not None:
+            self.close()
 
     def update(self, uri, content=None):
-        """ Updates the resource matching the passed URI """
+        """ Updates the resource matching the passed URI. The clients are not notified right away :
+        the updates received during update_delay are coalesced so that a burst of updates on the
+        same resource (a transaction modifying several rows for instance) ends up in a single
+        invalidate notice carrying the latest content.
+        """
         if uri in self._resources:
-            self._resources[uri].update(content)
+            self._pending_updates[uri] = content
+
+            if self._flush_handle is None:
+                self._flush_handle = self._event_loop.call_later(self._update_delay,
+                                                                 self._flush_pending_updates)
+
+    def _flush_pending_updates(self):
+        """ Notifies the clients of all the resources updated since the last flush """
+        pending_updates = self._pending_updates
+        self._pending_updates = dict()
+        self._flush_handle = None
+        update_date = self._event_loop.time()
+
+        for uri, content in pending_updates.items():
+            resource = self._resources.get(uri)
+            if resource is not None:
+                resource.update(content, update_date)
 
     def watch(self, client, uri):
         """ Creates the Observer/Observed relation between client and the resource represented by
         uri. """
-        if not uri in self._resources:
-            self._resources[uri] = Resource(uri, self)
+        try:
+            resource = self._resources[uri]
+        except KeyError:
+            resource = self._resources[uri] = Resource(uri, self)
 
-        self._resources[uri].add_client(client)
+        client.watch(resource)
 
     def unwatch(self, client, uri):
         """ Breaks the Observer/Observed relation between client and the resource represented by
         uri. """
-        if uri in self._resources:
-            self._resources[uri].remove_client(client)
-
+        resource = self._resources.get(uri)
+        if resource is not None:
+            client.unwatch(resource)
 
     def remove_resource(self, resource):
         """
         Removes a resource from the consistency server (usually called when no client is listening
         to that resource anymore).
         """
-        if resource.uri in self._resources:
-            del self._resources[resource.uri]
+        self._resources.pop(resource.uri, None)
 
+    def _get_codec(self):
+        """
+        The codec used to encode and decode the messages exchanged with the clients and the backend
+        """
+        return self._codec
+    codec = property(_get_codec, doc="Application level protocol (JSON, MessagePack...)")
 
-if __name__ == '__main__':
-    PARSER = argparse.ArgumentParser(description='A simple program to keep your webapp\'s backend \
+    def _get_event_loop(self):
+        """
+        The event loop the server runs in (None until start() has been called)
+        """
+        return self._event_loop
+    event_loop = property(_get_event_loop, doc="Event loop running the server")
+
+    def _get_compress_threshold(self):
+        """
+        The minimal size in bytes of the notices compressed for the clients supporting
+        permessage-deflate (None if compression is disabled)
+        """
+        return self._compress_threshold
+    compress_threshold = property(_get_compress_threshold,
+                                  doc="Minimal size of the compressed notices (None : disabled)")
+
+
+def _serve(args, ready=None, **kwargs):
+    """
+    Runs a consistency server configured from the command line arguments until it is interrupted.
+    ready, if given, is a multiprocessing.Event set once the server is listening. kwargs are passed
+    to ConsistencyServer's constructor.
+    """
+    global CONSISTENCY_SERVER
+
+    if uvloop is not None and not args.no_uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    CONSISTENCY_SERVER = ConsistencyServer(args.public_hostname, args.backend_hostname,
+                                           args.public_port, args.backend_port,
+                                           Codec=CODECS[args.codec],
+                                           update_delay=args.update_delay,
+                                           compress_threshold=args.compress_threshold,
+                                           backend_unix_path=args.backend_unix_path, **kwargs)
+
+    async def _serve_until_interrupted():
+        """
+        Runs the server until an interrupt or termination signal is received (for instance on a
+        CTRL-C exit)
+        """
+        event_loop = asyncio.get_running_loop()
+        event_loop.add_signal_handler(signal.SIGINT, CONSISTENCY_SERVER.close)
+        event_loop.add_signal_handler(signal.SIGTERM, CONSISTENCY_SERVER.close)
+
+        await CONSISTENCY_SERVER.start()
+        if ready is not None:
+            ready.set()
+        await CONSISTENCY_SERVER.serve()
+
+    asyncio.run(_serve_until_interrupted())
+
+
+def _serve_workers(args):
+    """
+    Runs args.workers consistency servers in as many processes, all of them accepting clients on
+    the same public port (the kernel spreads the connections between them). The current process
+    accepts the backend connections and forwards the backend messages to each worker over a pair
+    of connected sockets. A worker terminates when its socket is closed by the current process,
+    and the current process stops (along with the other workers) when a worker exits.
+    """
+    # The workers are spawned rather than forked : a forked worker would inherit the relay end of
+    # the socket pairs and the main process exiting would then go unnoticed.
+    context = multiprocessing.get_context("spawn")
+    workers = list()
+    worker_socks = list()
+    try:
+        for _ in range(args.workers):
+            relay_sock, worker_sock = socket.socketpair()
+            ready = context.Event()
+            worker = context.Process(target=_serve, args=(args, ready),
+                                     kwargs={"reuse_port": True, "backend_sock": worker_sock})
+            worker.start()
+            worker_sock.close()
+            workers.append((worker, ready))
+            worker_socks.append(relay_sock)
+
+        for worker, ready in workers:
+            while not ready.wait(0.1):
+                if not worker.is_alive():
+                    sys.exit("A worker failed to start (exit code %s)" % worker.exitcode)
+
+        if uvloop is not None and not args.no_uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        if not asyncio.run(_relay_backend(args, worker_socks)):
+            sys.exit("A worker exited unexpectedly")
+    finally:
+        for worker, _ in workers:
+            worker.terminate()
+            worker.join()
+
+
+async def _relay_backend(args, worker_socks):
+    """
+    Accepts the backend connections and forwards their messages to the workers connected to
+    worker_socks until an interrupt or termination signal is received or a worker exits. Returns
+    False in the latter case.
+    """
+    event_loop = asyncio.get_running_loop()
+    interrupted = asyncio.Event()
+    workers_alive = True
+
+    def worker_lost():
+        nonlocal workers_alive
+        if not interrupted.is_set():
+            LOGGER.error("A worker exited, stopping the consistency server")
+            workers_alive = False
+            interrupted.set()
+
+    relays = list()
+    for sock in worker_socks:
+        transport, _ = await event_loop.create_connection(lambda: WorkerLinkProtocol(worker_lost),
+                                                          sock=sock)
+        relays.append(transport)
+
+    if args.backend_unix_path is not None:
+        server = await event_loop.create_unix_server(lambda: BackendRelayProtocol(relays),
+                                                     args.backend_unix_path)
+    else:
+        server = await event_loop.create_server(lambda: BackendRelayProtocol(relays),
+                                                args.backend_hostname, args.backend_port)
+
+    event_loop.add_signal_handler(signal.SIGINT, interrupted.set)
+    event_loop.add_signal_handler(signal.SIGTERM, interrupted.set)
+    await interrupted.wait()
+
+    server.close()
+    for transport in relays:
+        transport.close()
+    return workers_alive
+
+
+def main():
+    """
+    The command line entry point. It's also the way to start the server when the module has been
+    compiled with Cython (see the README) since it can't be run as a script then.
+    """
+    parser = argparse.ArgumentParser(description='A simple program to keep your webapp\'s backend \
 consistent with your frontend in a lightweight, fast and fashionable way (using websockets). It \
 will be paired with the consistency JavaScript client (unless you want to write your own client) \
 and if you are using Django, you can use consistency-django for an almost seamless integration in \
@@ -263,33 +914,48 @@ framework, please let me know (etienne.lafarge@gmail.com) so that I can advertis
 Consistency\'s website and documentation.', epilog='In case you\'re wondering, you can exit the \
 program with CTRL-C or sending it a SIGINT signal.')
 
-    PARSER.add_argument('-a', '--public-hostname', type=str, help='The hostname for the clients \
+    parser.add_argument('-a', '--public-hostname', type=str, help='The hostname for the clients \
 access. The default localhost should work anyway.', default="localhost")
-    PARSER.add_argument('-p', '--public-port', type=int, help='The port number for the clients \
+    parser.add_argument('-p', '--public-port', type=int, help='The port number for the clients \
 access. Default is 4691.', default=4691)
-    PARSER.add_argument('-s', '--backend-hostname', type=str, help='The hostname for the backend \
+    parser.add_argument('-s', '--backend-hostname', type=str, help='The hostname for the backend \
 access. The default localhost should work anyway.', default="localhost")
-    PARSER.add_argument('-c', '--backend-port', type=int, help='The port number for the backend \
+    parser.add_argument('-c', '--backend-port', type=int, help='The port number for the backend \
 access. Default is 1991.', default=1991)
+    parser.add_argument('-u', '--backend-unix-path', type=str, help='The path of a Unix domain \
+socket for the backend access, used instead of the backend hostname and port. It\'s faster when \
+the backend runs on the same machine.', default=None)
+    parser.add_argument('-f', '--codec', type=str, choices=sorted(CODECS), help='The format of \
+the messages exchanged with the clients and the backend. msgpack requires the msgpack package. \
+Default is json.', default="json")
+    parser.add_argument('-d', '--update-delay', type=float, help='The time (in seconds) during \
+which the updates of a resource sent by the backend are coalesced into a single notice to the \
+clients. Default is 0.005.', default=0.005)
+    parser.add_argument('-z', '--compress-threshold', type=int, help='Enables permessage-deflate \
+for the clients that support it : the notices of at least this many bytes are compressed (once for \
+all the clients). Compression is disabled by default.', default=None)
+    parser.add_argument('--no-uvloop', action='store_true', help='Use the default asyncio event \
+loop even if uvloop is installed. By default, uvloop (a faster implementation of the event loop \
+built on top of libuv) is used whenever it is available.')
+    parser.add_argument('-w', '--workers', type=int, help='The number of processes serving the \
+clients. With more than one, the connections of the clients are spread between them (using \
+SO_REUSEPORT, Linux and BSD only) and the backend messages are forwarded to all of them. Default \
+is 1.', default=1)
+
+    args = parser.parse_args()
+
+    if args.codec == "msgpack" and msgpack is None:
+        parser.error("the msgpack codec requires the msgpack package (pip install msgpack)")
+
+    if args.workers < 1:
+        parser.error("there must be at least one worker")
 
-    ARGS = PARSER.parse_args()
-
-    PUBLIC_HOSTNAME = ARGS.public_hostname
-    PUBLIC_PORT = ARGS.public_port
-    BACKEND_HOSTNAME = ARGS.backend_hostname
-    BACKEND_PORT = ARGS.backend_port
-
-    CONSISTENCY_SERVER = ConsistencyServer(PUBLIC_HOSTNAME, BACKEND_HOSTNAME,
-                                           PUBLIC_PORT, BACKEND_PORT)
-
-    def _on_close_request():
-        """
-        Called when an interrupt signal is received (for instance on a CTRL-C exit)
-        """
-        CONSISTENCY_SERVER.close()
-        sys.exit(0)
+    print("Starting Consistency Server now...")
+    if args.workers == 1:
+        _serve(args)
+    else:
+        _serve_workers(args)
 
-    signal.signal(signal.SIGINT, _on_close_request)
 
-    print("Starting Consistency Server now...")
-    CONSISTENCY_SERVER.run_forvever()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the hand-written wire formats of the consistency server : the WebSocket frames built once
+for all the clients, the deflate payloads they may hold, the notices spliced from the codec
+templates and the length-prefixed messages sent by the backend. The way the server fans the updates
+out to the clients is tested with fake client connections.
+"""
+
+import zlib
+import struct
+import socket
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import consistency_server
+from consistency_server import (MAX_MESSAGE_SIZE, MAX_QUEUED_MESSAGES, Client, ClientProtocol,
+                                ConsistencyServer, FramedProtocol, JSONCodec, MsgPackCodec,
+                                build_frame, deflate_payload, msgpack)
+
+
+def parse_frame(frame):
+    """
+    Minimal RFC 6455 parser for an unmasked server to client frame. Returns (fin, rsv1, opcode,
+    payload) and checks that frame holds exactly one frame.
+    """
+    first_byte, second_byte = frame[0], frame[1]
+    assert not second_byte & 0x80, "server frames must not be masked"
+
+    length = second_byte & 0x7f
+    offset = 2
+    if length == 126:
+        length, = struct.unpack_from('!H', frame, offset)
+        offset += 2
+    elif length == 127:
+        length, = struct.unpack_from('!Q', frame, offset)
+        offset += 8
+
+    assert len(frame) == offset + length, "frame length doesn't match its header"
+    return bool(first_byte & 0x80), bool(first_byte & 0x40), first_byte & 0x0f, frame[offset:]
+
+
+class BuildFrameTest(unittest.TestCase):
+    """ build_frame must produce valid frames whatever the length encoding """
+
+    def assert_round_trip(self, payload, header_length, binary=False):
+        frame = build_frame(payload, binary)
+        self.assertEqual(len(frame), header_length + len(payload))
+        self.assertEqual(parse_frame(frame), (True, False, 0x2 if binary else 0x1, payload))
+
+    def test_7_bit_length(self):
+        self.assert_round_trip(b'', 2)
+        self.assert_round_trip(b'{"message":"invalidate"}', 2)
+        self.assert_round_trip(b'x' * 125, 2)
+
+    def test_16_bit_length(self):
+        self.assert_round_trip(b'x' * 126, 4)
+        self.assert_round_trip(b'x' * 0xffff, 4)
+
+    def test_64_bit_length(self):
+        self.assert_round_trip(b'x' * 0x10000, 10)
+        self.assert_round_trip(b'x' * 100000, 10, binary=True)
+
+    def test_binary_opcode(self):
+        self.assert_round_trip(b'\x82\xa3uri', 2, binary=True)
+
+    def test_compressed_flag(self):
+        fin, rsv1, opcode, payload = parse_frame(build_frame(b'abc', compressed=True))
+        self.assertEqual((fin, rsv1, opcode, payload), (True, True, 0x1, b'abc'))
+
+
+class DeflatePayloadTest(unittest.TestCase):
+    """ deflate_payload must produce what a permessage-deflate client can inflate (RFC 7692) """
+
+    def inflate(self, inflater, data):
+        return inflater.decompress(data + b'\x00\x00\xff\xff')
+
+    def test_round_trip(self):
+        payload = b'{"message":"invalidate","data":{"uri":"/a","content":"' + b'abc' * 500 + b'"}}'
+        compressed = deflate_payload(payload)
+        self.assertFalse(compressed.endswith(b'\x00\x00\xff\xff'))
+        self.assertEqual(self.inflate(zlib.decompressobj(-zlib.MAX_WBITS), compressed), payload)
+
+    def test_empty_payload(self):
+        self.assertEqual(self.inflate(zlib.decompressobj(-zlib.MAX_WBITS), deflate_payload(b'')),
+                         b'')
+
+    def test_independent_messages(self):
+        # A client keeping its inflate context between messages must still read payloads that were
+        # each compressed on their own (and may be interleaved with other messages)
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        for payload in (b'first' * 100, b'second' * 100, b'first' * 100):
+            self.assertEqual(self.inflate(inflater, deflate_payload(payload)), payload)
+
+
+class InvalidateTemplateTest(unittest.TestCase):
+    """
+    A notice spliced from invalidate_template and the encoded content must decode to the same
+    message as if it had been built and encoded in one go
+    """
+
+    URIS = ['/a', '', '/"quoted"/', 'back\\slash', '/caf\u00e9/\u2603', '/line\nbreak\x00\x1f']
+    CONTENTS = ['text', '', {"title": "Hello", "tags": ["a", "b"], "nested": {"x": None}}, 0, -42,
+                2 ** 40, True, False, 'long content ' * 5000]
+
+    def assert_round_trip(self, codec):
+        for uri in self.URIS:
+            prefix, suffix = codec.invalidate_template(uri)
+            for content in self.CONTENTS:
+                with self.subTest(uri=uri, content=repr(content)[:40]):
+                    notice = codec.decode(prefix + codec.encode(content) + suffix)
+                    self.assertEqual(notice, {"message": "invalidate",
+                                              "data": {"uri": uri, "content": content}})
+
+    def test_json_codec(self):
+        self.assert_round_trip(JSONCodec())
+
+    @unittest.skipIf(msgpack is None, "msgpack isn't installed")
+    def test_msgpack_codec(self):
+        self.assert_round_trip(MsgPackCodec())
+
+
+class RecordingProtocol(FramedProtocol):
+    """ A FramedProtocol keeping the messages it receives """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = list()
+
+    def message_received(self, msg):
+        self.messages.append(msg)
+
+
+class FakeTransport:
+    """ Just enough of an asyncio transport for FramedProtocol """
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def frame_message(msg):
+    """ Prefixes msg with its length, the way the backend sends it """
+    return struct.pack('>I', len(msg)) + msg
+
+
+class FramedProtocolTest(unittest.TestCase):
+    """ FramedProtocol must split the backend stream into messages whatever the TCP reads """
+
+    MESSAGES = [b'{"message":"update","data":{"uri":"/a"}}', b'', b'x' * 70000]
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.protocol = RecordingProtocol()
+        self.protocol.connection_made(self.transport)
+        self.stream = b''.join(frame_message(msg) for msg in self.MESSAGES)
+
+    def test_one_message_per_read(self):
+        for msg in self.MESSAGES:
+            self.protocol.data_received(frame_message(msg))
+        self.assertEqual(self.protocol.messages, self.MESSAGES)
+
+    def test_concatenated_messages(self):
+        self.protocol.data_received(self.stream)
+        self.assertEqual(self.protocol.messages, self.MESSAGES)
+
+    def test_split_messages(self):
+        for size in (1, 3, 7, 1000):
+            self.setUp()
+            for offset in range(0, len(self.stream), size):
+                self.protocol.data_received(self.stream[offset:offset + size])
+            self.assertEqual(self.protocol.messages, self.MESSAGES)
+
+    def test_partial_message_waits(self):
+        self.protocol.data_received(self.stream[:10])
+        self.assertEqual(self.protocol.messages, [])
+        self.protocol.data_received(self.stream[10:])
+        self.assertEqual(self.protocol.messages, self.MESSAGES)
+        self.assertFalse(self.transport.closed)
+
+    def test_bad_message_is_skipped(self):
+        def message_received(msg):
+            if msg == b'bad':
+                raise KeyError('uri')
+            self.protocol.messages.append(msg)
+
+        self.protocol.message_received = message_received
+        with self.assertLogs('consistency_server', 'ERROR'):
+            self.protocol.data_received(frame_message(b'first') + frame_message(b'bad')
+                                        + frame_message(b'second'))
+        self.assertEqual(self.protocol.messages, [b'first', b'second'])
+        self.assertFalse(self.transport.closed)
+
+    def test_oversized_message_closes(self):
+        self.protocol.data_received(struct.pack('>I', MAX_MESSAGE_SIZE + 1))
+        self.assertTrue(self.transport.closed)
+        self.assertEqual(self.protocol.messages, [])
+
+    def test_unframed_backend_closes(self):
+        # The first bytes of an unframed JSON message read as a length of about 2 GB
+        self.protocol.data_received(b'{"message": "update", "data": {"uri": "/a"}}')
+        self.assertTrue(self.transport.closed)
+
+
+class FakeClientProtocol:
+    """ Just enough of a ClientProtocol for Client, keeping the notices written to the client """
+
+    deflate = False
+
+    def __init__(self, writable=True):
+        self.frames = list()
+        self.dropped = False
+        self._writable = asyncio.Event()
+        if writable:
+            self._writable.set()
+
+    async def wait_writable(self):
+        await self._writable.wait()
+
+    def invalidate(self, frame):
+        self.frames.append(frame)
+
+    def dropConnection(self, abort=False):
+        self.dropped = True
+
+    def notices(self):
+        """ The messages received by the client, decoded """
+        return [JSONCodec().decode(parse_frame(frame)[3]) for frame in self.frames]
+
+
+def free_port():
+    """ Returns a TCP port nobody is listening on (autobahn doesn't accept port 0) """
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class ServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """ Runs a consistency server during each test, the clients are fake ones """
+
+    UPDATE_DELAY = 0.01
+
+    async def asyncSetUp(self):
+        self.server = ConsistencyServer("localhost", "localhost", free_port(), free_port(),
+                                        update_delay=self.UPDATE_DELAY)
+        await self.server.start()
+        self.serving = asyncio.ensure_future(self.server.serve())
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.serving
+
+    def connect_client(self, writable=True):
+        """ Returns a Client sending its notices to a FakeClientProtocol """
+        client = Client(FakeClientProtocol(writable))
+        client.start_writing()
+        self.addCleanup(client.stop_writing)
+        return client
+
+    async def wait_for_flush(self):
+        await asyncio.sleep(self.UPDATE_DELAY * 5)
+
+
+class CoalescingTest(ServerTestCase):
+    """ The updates of a resource received during update_delay must end up in a single notice """
+
+    async def test_burst_keeps_latest_content(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        for content in ("first", {"second": 2}, "latest"):
+            self.server.update("/a", content)
+        await self.wait_for_flush()
+        self.assertEqual(client.protocol.notices(),
+                         [{"message": "invalidate", "data": {"uri": "/a", "content": "latest"}}])
+
+    async def test_burst_ending_without_content(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.update("/a", "stale")
+        self.server.update("/a")
+        await self.wait_for_flush()
+        self.assertEqual(client.protocol.notices(),
+                         [{"message": "invalidate", "data": {"uri": "/a"}}])
+
+    async def test_resources_are_coalesced_separately(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.watch(client, "/b")
+        self.server.update("/a", 1)
+        self.server.update("/b", 2)
+        self.server.update("/a", 3)
+        await self.wait_for_flush()
+        self.assertCountEqual(client.protocol.notices(),
+                              [{"message": "invalidate", "data": {"uri": "/a", "content": 3}},
+                               {"message": "invalidate", "data": {"uri": "/b", "content": 2}}])
+
+    async def test_later_update_is_notified_again(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.update("/a", 1)
+        await self.wait_for_flush()
+        self.server.update("/a", 2)
+        await self.wait_for_flush()
+        self.assertEqual([notice["data"]["content"] for notice in client.protocol.notices()],
+                         [1, 2])
+
+    async def test_unwatched_resource_is_ignored(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.update("/b", "nobody is watching")
+        await self.wait_for_flush()
+        self.assertEqual(client.protocol.frames, [])
+
+
+class SlowClientTest(ServerTestCase):
+    """ A client unable to keep up with the notices must be dropped without holding the others """
+
+    async def test_overflowing_client_is_dropped(self):
+        slow_client = self.connect_client(writable=False)
+        client = self.connect_client()
+        self.server.watch(slow_client, "/a")
+        self.server.watch(slow_client, "/b")
+        self.server.watch(client, "/a")
+
+        # Updating the resource directly, since the updates coalesced by the server would never
+        # fill the queue
+        resource = self.server._resources["/a"]
+        updates = MAX_QUEUED_MESSAGES + 10
+        for content in range(updates):
+            resource.update(content)
+            await asyncio.sleep(0)
+
+        self.assertTrue(slow_client.protocol.dropped)
+        self.assertFalse(client.protocol.dropped)
+        self.assertEqual(len(client.protocol.frames), updates)
+
+        # The dropped client doesn't watch anything anymore, "/b" is left without listeners
+        self.assertIn("/a", self.server._resources)
+        self.assertNotIn("/b", self.server._resources)
+        slow_client.protocol.dropped = False
+        resource.update("after the drop")
+        self.assertFalse(slow_client.protocol.dropped)
+
+
+class WatchCleanupTest(ServerTestCase):
+    """
+    Unwatching a resource or closing the connection must break the relation on both sides, and a
+    resource nobody watches anymore must be forgotten by the server
+    """
+
+    async def notified_uris(self, *clients):
+        """ Updates all the resources and returns the URIs each client got a notice for """
+        for uri in ("/a", "/b"):
+            self.server.update(uri)
+        await self.wait_for_flush()
+        uris = [sorted(notice["data"]["uri"] for notice in client.protocol.notices())
+                for client in clients]
+        for client in clients:
+            client.protocol.frames.clear()
+        return uris
+
+    async def test_unwatch(self):
+        client = self.connect_client()
+        other_client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.watch(client, "/b")
+        self.server.watch(other_client, "/a")
+
+        self.server.unwatch(client, "/a")
+        self.assertIn("/a", self.server._resources)
+        self.assertEqual(await self.notified_uris(client, other_client), [["/b"], ["/a"]])
+
+        self.server.unwatch(client, "/b")
+        self.assertNotIn("/b", self.server._resources)
+        self.assertEqual(await self.notified_uris(client, other_client), [[], ["/a"]])
+
+        # Unwatching again, or a resource that doesn't exist, changes nothing
+        self.server.unwatch(client, "/b")
+        self.server.unwatch(client, "/unknown")
+        self.assertEqual(list(self.server._resources), ["/a"])
+
+    async def test_watch_twice(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.watch(client, "/a")
+        self.assertEqual(await self.notified_uris(client), [["/a"]])
+        self.server.unwatch(client, "/a")
+        self.assertEqual(self.server._resources, {})
+
+    async def test_watch_again_after_removal(self):
+        client = self.connect_client()
+        self.server.watch(client, "/a")
+        self.server.unwatch(client, "/a")
+        self.server.watch(client, "/a")
+        self.assertEqual(await self.notified_uris(client), [["/a"]])
+
+    async def test_close(self):
+        other_client = self.connect_client()
+        self.server.watch(other_client, "/a")
+
+        protocol = ClientProtocol()
+        with mock.patch.object(consistency_server, "CONSISTENCY_SERVER", self.server):
+            protocol.onConnect(SimpleNamespace(protocols=[]))
+        client = protocol._client_representation
+        self.server.watch(client, "/a")
+        self.server.watch(client, "/b")
+
+        protocol.onClose(False, 1006, None)
+        self.assertEqual(list(self.server._resources), ["/a"])
+        self.assertEqual(await self.notified_uris(other_client), [["/a"]])
+
+        # autobahn may report the closing more than once
+        protocol.onClose(False, 1006, None)
+        self.server.unwatch(other_client, "/a")
+        self.assertEqual(self.server._resources, {})
+
+
+if __name__ == '__main__':
+    unittest.main()